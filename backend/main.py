@@ -1,11 +1,15 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, request, jsonify, send_file
 from flask_cors import CORS
 from faster_whisper import WhisperModel
 import os
 import tempfile
 import logging
 from werkzeug.utils import secure_filename
-from datetime import timedelta
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import MappingProxyType
+import hashlib
+import threading
 import io
 import torch
 
@@ -17,13 +21,83 @@ logger = logging.getLogger(__name__)
 
 UPLOAD_FOLDER = 'temp_uploads'
 MAX_CONTENT_LENGTH = 1000 * 1024 * 1024  
-ALLOWED_EXTENSIONS = {'wav', 'mp3', 'mp4', 'm4a', 'flac', 'ogg', 'webm', 'aac'}
+ALLOWED_EXTENSIONS = frozenset({'wav', 'mp3', 'mp4', 'm4a', 'flac', 'ogg', 'webm', 'aac'})
+INVALID_FILE_TYPE_ERROR = 'Invalid file type. Supported formats: ' + ', '.join(ALLOWED_EXTENSIONS)
+
+# Number of transcribe() calls the model can serve in parallel across request threads
+NUM_WORKERS = 2
+
+# Received uploads allowed to run or wait for transcription at once. Uploads
+# still being transferred don't hold a slot; MAX_CONTENT_LENGTH bounds those
+MAX_PENDING_TRANSCRIPTIONS = NUM_WORKERS * 2
+# Seconds clients are told to wait before retrying when the server is busy
+BUSY_RETRY_AFTER = 30
+
+# Decoding options shared by every transcription request. Read-only, since
+# cached transcriptions are only valid for the options they were made with
+TRANSCRIBE_OPTIONS = MappingProxyType({
+    'beam_size': 5,
+    'language': None,
+    'task': 'transcribe'
+})
+
+# Number of finished transcriptions kept in memory, keyed by audio content hash
+TRANSCRIPTION_CACHE_SIZE = 32
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+class HashingTempFile:
+    """Named temp file that hashes and counts uploaded bytes as they are written"""
+    
+    def __init__(self, suffix):
+        self._file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
+        self._digest = hashlib.blake2b(digest_size=16)
+        self.name = self._file.name
+        self.size = 0
+    
+    def write(self, data):
+        self._digest.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+    
+    def digest(self):
+        return self._digest.digest()
+    
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class UploadRequest(Request):
+    """Request that spools file uploads straight into named temp files
+    
+    Werkzeug would otherwise spool large uploads to its own anonymous temp
+    file, forcing a second copy to get a path the decoder can open. The files
+    are removed when the request is closed at the end of the request context.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.temp_upload_paths = []
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = HashingTempFile(os.path.splitext(secure_filename(filename or ''))[1])
+        self.temp_upload_paths.append(stream.name)
+        return stream
+    
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for path in self.temp_upload_paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+app.request_class = UploadRequest
+
 def check_cuda_availability():
     """Check if CUDA is available and return appropriate device and compute type"""
     try:
@@ -52,8 +126,13 @@ def initialize_model():
     try:
         device, compute_type = check_cuda_availability()
         
-        logger.info(f"Initializing Whisper model with device: {device}, compute_type: {compute_type}")
-        model = WhisperModel("large-v3", device=device, compute_type=compute_type)
+        logger.info(f"Initializing Whisper model with device: {device}, compute_type: {compute_type}, workers: {NUM_WORKERS}")
+        model = WhisperModel(
+            "large-v3",
+            device=device,
+            compute_type=compute_type,
+            num_workers=NUM_WORKERS
+        )
         
         logger.info("Whisper model loaded successfully")
         return model, device, compute_type
@@ -61,56 +140,157 @@ def initialize_model():
         logger.error(f"Failed to load Whisper model: {e}")
         return None, None, None
 
+def get_gpu_info():
+    """Collect GPU details that do not change while the process is running"""
+    try:
+        cuda_available = torch.cuda.is_available()
+        return {
+            'cuda_available': cuda_available,
+            'gpu_count': torch.cuda.device_count() if cuda_available else 0,
+            'gpu_name': torch.cuda.get_device_name(0) if cuda_available else None
+        }
+    except Exception as e:
+        logger.warning(f"Error reading GPU info: {e}. Reporting no GPU")
+        return {'cuda_available': False, 'gpu_count': 0, 'gpu_name': None}
+
 # Initialize model
 model, device_used, compute_type_used = initialize_model()
 
+# Probed once at startup so health checks don't query CUDA on every poll
+gpu_info = get_gpu_info()
+
+transcription_cache = OrderedDict()
+transcription_cache_lock = threading.Lock()
+transcription_slots = threading.BoundedSemaphore(MAX_PENDING_TRANSCRIPTIONS)
+
 def allowed_file(filename):
     """Check if the file extension is allowed"""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, sep, extension = filename.rpartition('.')
+    return bool(sep) and extension.lower() in ALLOWED_EXTENSIONS
 
 def format_timestamp(seconds):
     """Convert seconds to SRT timestamp format (HH:MM:SS,mmm)"""
-    td = timedelta(seconds=seconds)
-    total_seconds = int(td.total_seconds())
-    hours = total_seconds // 3600
-    minutes = (total_seconds % 3600) // 60
-    secs = total_seconds % 60
-    milliseconds = int((seconds - total_seconds) * 1000)
+    total_milliseconds = int(round(seconds * 1000))
+    hours, remainder = divmod(total_milliseconds, 3600000)
+    minutes, remainder = divmod(remainder, 60000)
+    secs, milliseconds = divmod(remainder, 1000)
     
-    return f"{hours:02d}:{minutes:02d}:{secs:02d},{milliseconds:03d}"
+    return "%02d:%02d:%02d,%03d" % (hours, minutes, secs, milliseconds)
 
-def transcribe_to_srt(audio_file_path):
-    """Transcribe audio file and return SRT content"""
+def run_transcription(audio_file_path, key):
+    """Transcribe audio file, reusing the result of an identical earlier upload
+    
+    key is the content hash of the file, as returned by get_temp_upload.
+    
+    Returns a (segments, language, language_probability) tuple where segments
+    is a list of (start, end, text) tuples.
+    """
     if model is None:
         raise Exception("Whisper model not loaded")
     
+    with transcription_cache_lock:
+        cached = transcription_cache.get(key)
+        if cached is not None:
+            transcription_cache.move_to_end(key)
+            logger.debug("Reusing cached transcription")
+            return cached
+    
+    segments, info = model.transcribe(audio_file_path, **TRANSCRIBE_OPTIONS)
+    
+    logger.info("Detected language: %s (probability: %.2f)", info.language, info.language_probability)
+    
+    result = (
+        [(segment.start, segment.end, segment.text.strip()) for segment in segments],
+        info.language,
+        info.language_probability
+    )
+    
+    with transcription_cache_lock:
+        transcription_cache[key] = result
+        if len(transcription_cache) > TRANSCRIPTION_CACHE_SIZE:
+            transcription_cache.popitem(last=False)
+    
+    return result
+
+def transcribe_to_srt(audio_file_path, key):
+    """Transcribe audio file and return the UTF-8 SRT content in a BytesIO"""
     try:
-        segments, info = model.transcribe(
-            audio_file_path, 
-            beam_size=5,
-            language=None,  
-            task="transcribe"
-        )
-        
-        logger.info(f"Detected language: {info.language} (probability: {info.language_probability:.2f})")
+        segments, language, language_probability = run_transcription(audio_file_path, key)
         
-        srt_content = []
+        # Entries are encoded straight into the response buffer instead of
+        # being collected, joined and encoded as one large string
+        srt_bytes = io.BytesIO()
         
-        for i, segment in enumerate(segments, 1):
-            start_time = format_timestamp(segment.start)
-            end_time = format_timestamp(segment.end)
-            text = segment.text.strip()
+        for i, (start, end, text) in enumerate(segments, 1):
+            start_time = format_timestamp(start)
+            end_time = format_timestamp(end)
             
-            srt_entry = f"{i}\n{start_time} --> {end_time}\n{text}\n"
-            srt_content.append(srt_entry)
+            separator = "\n" if i > 1 else ""
+            srt_entry = f"{separator}{i}\n{start_time} --> {end_time}\n{text}\n"
+            srt_bytes.write(srt_entry.encode('utf-8'))
         
-        return "\n".join(srt_content)
+        srt_bytes.seek(0)
+        return srt_bytes
     
     except Exception as e:
-        logger.error(f"Transcription error: {e}")
+        logger.error("Transcription error: %s", e)
         raise
 
+@contextmanager
+def transcription_slot():
+    """Hold one of MAX_PENDING_TRANSCRIPTIONS slots; yields False when none is free
+    
+    Only take a slot after the request body has been received, so slow uploads
+    can't starve transcription and the busy response isn't sent on a socket
+    that still has unread data.
+    """
+    acquired = transcription_slots.acquire(blocking=False)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            transcription_slots.release()
+
+def busy_response():
+    """503 response telling the client when to retry"""
+    return (
+        jsonify({'error': 'Server is busy, please try again later'}),
+        503,
+        {'Retry-After': str(BUSY_RETRY_AFTER)}
+    )
+
+def get_uploaded_audio():
+    """Validate the 'audio' file of the current request
+    
+    Returns (file, None) on success or (None, error_response) otherwise.
+    """
+    if 'audio' not in request.files:
+        return None, (jsonify({'error': 'No audio file provided'}), 400)
+    
+    file = request.files['audio']
+    
+    if file.filename == '':
+        return None, (jsonify({'error': 'No file selected'}), 400)
+    
+    if not allowed_file(file.filename):
+        return None, (jsonify({'error': INVALID_FILE_TYPE_ERROR}), 400)
+    
+    if model is None:
+        return None, (jsonify({'error': 'Transcription model not available'}), 500)
+    
+    return file, None
+
+def get_temp_upload(file):
+    """Return (path, size, digest) of an upload spooled by UploadRequest
+    
+    The size and content hash were computed while Werkzeug wrote the file, so
+    it doesn't have to be stat'ed or read back. The file is removed when the
+    request closes.
+    """
+    upload = file.stream
+    upload.flush()
+    return upload.name, upload.size, upload.digest()
+
 @app.route('/', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -120,49 +300,35 @@ def health_check():
         'model_loaded': model is not None,
         'device': device_used,
         'compute_type': compute_type_used,
-        'cuda_available': torch.cuda.is_available(),
-        'gpu_count': torch.cuda.device_count() if torch.cuda.is_available() else 0,
-        'gpu_name': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None
+        **gpu_info
     })
 
 @app.route('/upload', methods=['POST'])
 def upload_audio():
     """Handle audio file upload and transcription"""
     try:
-        if 'audio' not in request.files:
-            return jsonify({'error': 'No audio file provided'}), 400
-        
-        file = request.files['audio']
-        
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({
-                'error': 'Invalid file type. Supported formats: ' + ', '.join(ALLOWED_EXTENSIONS)
-            }), 400
-        
-        if model is None:
-            return jsonify({'error': 'Transcription model not available'}), 500
+        file, error_response = get_uploaded_audio()
+        if error_response is not None:
+            return error_response
         
         filename = secure_filename(file.filename)
+        temp_file_path, file_size, file_hash = get_temp_upload(file)
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as tmp_file:
-            file.save(tmp_file.name)
-            temp_file_path = tmp_file.name
+        if file_size == 0:
+            return jsonify({'error': 'Uploaded file is empty'}), 400
         
-        logger.info(f"Processing file: {filename} on {device_used}")
-        
-        try:
-            srt_content = transcribe_to_srt(temp_file_path)
+        with transcription_slot() as acquired:
+            if not acquired:
+                return busy_response()
+            
+            logger.info("Processing file: %s on %s", filename, device_used)
+            
+            srt_bytes = transcribe_to_srt(temp_file_path, file_hash)
             
             base_filename = os.path.splitext(filename)[0]
             srt_filename = f"{base_filename}_transcription.srt"
             
-            # Create a BytesIO object with the SRT content
-            srt_bytes = io.BytesIO(srt_content.encode('utf-8'))
-            
-            logger.info(f"Transcription completed for: {filename}")
+            logger.info("Transcription completed for: %s", filename)
             
             return send_file(
                 srt_bytes,
@@ -170,67 +336,46 @@ def upload_audio():
                 as_attachment=True,
                 download_name=srt_filename
             )
-            
-        finally:
-            try:
-                os.unlink(temp_file_path)
-            except OSError:
-                pass
     
     except Exception as e:
-        logger.error(f"Upload error: {e}")
+        logger.error("Upload error: %s", e)
         return jsonify({'error': f'An error occurred during processing: {str(e)}'}), 500
 
 @app.route('/transcribe', methods=['POST'])
 def transcribe_only():
     """Alternative endpoint that returns JSON with transcription text"""
     try:
-        if 'audio' not in request.files:
-            return jsonify({'error': 'No audio file provided'}), 400
-        
-        file = request.files['audio']
-        
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({
-                'error': 'Invalid file type. Supported formats: ' + ', '.join(ALLOWED_EXTENSIONS)
-            }), 400
-        
-        if model is None:
-            return jsonify({'error': 'Transcription model not available'}), 500
+        file, error_response = get_uploaded_audio()
+        if error_response is not None:
+            return error_response
         
         filename = secure_filename(file.filename)
+        temp_file_path, file_size, file_hash = get_temp_upload(file)
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as tmp_file:
-            file.save(tmp_file.name)
-            temp_file_path = tmp_file.name
+        if file_size == 0:
+            return jsonify({'error': 'Uploaded file is empty'}), 400
         
-        logger.info(f"Processing file: {filename} on {device_used}")
-        
-        try:
-            segments, info = model.transcribe(temp_file_path, beam_size=5)
+        with transcription_slot() as acquired:
+            if not acquired:
+                return busy_response()
             
-            transcription_text = " ".join([segment.text.strip() for segment in segments])
+            logger.info("Processing file: %s on %s", filename, device_used)
+            
+            segments, language, language_probability = run_transcription(temp_file_path, file_hash)
+            
+            transcription_text = " ".join([text for _, _, text in segments])
             
             return jsonify({
                 'transcription': transcription_text,
-                'language': info.language,
-                'language_probability': info.language_probability,
+                'language': language,
+                'language_probability': language_probability,
                 'filename': filename,
                 'device_used': device_used,
                 'compute_type_used': compute_type_used
             })
-            
-        finally:
-            try:
-                os.unlink(temp_file_path)
-            except OSError:
-                pass
     
     except Exception as e:
-        logger.error(f"Transcription error: {e}")
+        logger.error("Transcription error: %s", e)
         return jsonify({'error': f'An error occurred: {str(e)}'}), 500
 
 @app.route('/system-info', methods=['GET'])